@@ -22,13 +22,16 @@ import copy
 import struct
 import datetime
 
-from Lixx_file import LixxFile
+from Lixx_file import LixxFile, cache, timed
 
 class LixxDBF(LixxFile):
     """A model for reading and writing dbf files."""
 
-    def __init__(self, path, enable_gbk=True):
-        """@params: mode in ('rb', 'wb')"""
+    def __init__(self, path, enable_gbk=True, mode="rb+", **options):
+        """
+        @params: mode, "rb+" recreates a file it can not parse, "rb" only reads and raises instead
+        @params: options, the LixxFile backend options
+        """
         self.path = path
         self.enable_gbk = enable_gbk
         
@@ -43,10 +46,16 @@ class LixxDBF(LixxFile):
         self.offset = 0
         if path:
             try:
-                self.f = open(self.path, 'rb+')
+                super(LixxDBF, self).__init__(path, mode, **options)
+                self.f = self.fp
                 self._read_header()
             except Exception as e:
-                self.f = open(self.path, 'wb+')
+                if self.f:
+                    self.close()
+                if mode == 'rb':
+                    raise
+                super(LixxDBF, self).__init__(path, 'wb+', **options)
+                self.f = self.fp
         
     def __del__(self):
         self._close()
@@ -64,12 +73,15 @@ class LixxDBF(LixxFile):
             string += "\n"
         return string
 
+    def __exit__(self, exc_type, exc, tb):
+        self._close()
+
     def _close(self):
         if self.write_records and self.write_records != self.records:
             self.lixx_write()
 
         if self.f:
-            self.f.close()
+            self.close()
         self.f = None
 
     def __getitem__(self, row, col=None):
@@ -86,46 +98,52 @@ class LixxDBF(LixxFile):
         pass
 
     def _read_header(self):
-        f = self.f
         fields = self.fields
 
-        numrec, lenheader = struct.unpack('<xxxxLH22x', self._read(f, 32))
+        numrec, lenheader = struct.unpack('<xxxxLH22x', self.read_at(0, 32))
         numfields = (lenheader - 33) // 32
 
-        for fieldno in range(numfields):
-            name, typ, size, deci = struct.unpack('<11sc4xBB14x', self._read(f, 32))
-            name=name.decode('utf-8')
+        fieldspecs = self.read_at(32, numfields * 32)
+        for name, typ, size, deci in struct.iter_unpack('<11sc4xBB14x', fieldspecs):
+            name=name.decode(self.enable_gbk and 'GBK' or 'utf-8')
             typ=typ.decode('utf-8')
             name = name.replace('\0', '')
             fields.append((name, typ, size, deci))
         self.fieldnames = [field[0] for field in fields]
         self.fieldspecs = [tuple(field[1:]) for field in fields]
 
+        self.offset = 32 + numfields * 32
         self.numrec = numrec
         return self.fieldnames, self.fieldspecs
 
+    @timed()
     def _read_records(self):
         if self.records:
+            cache("LixxDBF.records", True)
             return self.records
+        cache("LixxDBF.records", False)
 
         if not (self.fieldnames or self.fieldspecs):
             self._read_header()
         
-        f = self.f
         fields = self.fields
         numrec = self.numrec
         records = self.records
-        records = self.records
 
-        terminator = self._read(f, 1)
+        terminator = bytes(self.read_at(self.offset, 1))
         terminator=terminator.decode('utf-8')
         assert terminator == '\r'
+        self.offset += 1
 
         fields.insert(0, ('DeletionFlag', 'C', 1, 0))
         fmt = ''.join(['%ds' % fieldinfo[2] for fieldinfo in fields])
         fmtsiz = struct.calcsize(fmt)
-        for i in range(numrec):
-            recordb = struct.unpack(fmt, self._read(f, fmtsiz))
+
+        # all the records in one read, a short file keeps its whole records
+        data = self.read_at(self.offset, numrec * fmtsiz)
+        data = data[:len(data) - len(data) % fmtsiz]
+        self.offset += len(data)
+        for recordb in struct.iter_unpack(fmt, data):
             if len(recordb) > len(self.fieldnames):
                 recordb = recordb[1:]
             records.append(list(recordb))
@@ -148,8 +166,8 @@ class LixxDBF(LixxFile):
 
         # field specs
         for name, (typ, size, deci) in zip(fieldnames, fieldspecs):
-            name = name.ljust(11, '\x00')
-            name = name.encode('utf-8')
+            # same codec as _read_header, padded in bytes
+            name = name.encode(self.enable_gbk and 'GBK' or 'utf-8').ljust(11, b'\x00')
             typ = typ.encode('utf-8')
             fld = struct.pack('<11sc4xBB14x', name, typ, size, deci)
             f.write(fld)
@@ -216,6 +234,8 @@ class LixxDBF(LixxFile):
         else:
             self.records = records
 
+        # the backend view must not be exported while the file is written
+        self._invalidate()
         self._write_header(fieldnames, fieldspecs, records)
         self._write_records()
     
@@ -57,33 +57,363 @@
 #                              Sort Flag                     1 Bit
 #                              Size of Global Color Table    3 Bits
 
-import math
+import mmap
+import bisect
 import struct
 
-from PIL import Image
+import numpy as np
 
-class LixxGIF:
+from Lixx_file import LixxFile, cache, timed
+
+# bytes moved per read/write when shifting the tail of a file
+CHUNK_SIZE = 1 << 20
+
+def _shift(fp, start, delta, chunk_size=CHUNK_SIZE):
+    """
+    Move the bytes from `start` to EOF by `delta` in place, one chunk at a time.
+
+    The tail is copied backwards when growing and forwards when shrinking,
+    so no byte is overwritten before it has been copied. A shrunk file is
+    truncated.
+    """
+    end = fp.seek(0, 2)
+    if delta > 0:
+        pos = end
+        while pos > start:
+            n = min(chunk_size, pos - start)
+            pos -= n
+            fp.seek(pos)
+            buf = fp.read(n)
+            fp.seek(pos + delta)
+            fp.write(buf)
+    elif delta < 0:
+        pos = start
+        while pos < end:
+            n = min(chunk_size, end - pos)
+            fp.seek(pos)
+            buf = fp.read(n)
+            fp.seek(pos + delta)
+            fp.write(buf)
+            pos += n
+        fp.truncate(end + delta)
+
+class LixxGIF(LixxFile):
     """GIF Revision 89a"""
 
-    def __init__(self, path):
+    def __init__(self, path, mode="rb+", **options):
+        """@params: mode, "rb" for read only files; options, the LixxFile backend options"""
+        super(LixxGIF, self).__init__(path, mode, **options)
         self.path = path
-        self.fp = open(path, "rb+")
 
         self.s_dataStream = self._p_dataStream()
+        # block index, built on demand by `index`
+        self.blocks = None
+
+    def __del__(self):
+        self.close()
     
     def _p_dataStream(self):
         """Pointer to the end of global color table."""
-        fp = self.fp
-        assert fp.read(3) == b"GIF" and fp.read(3) == b"89a"
+        header = bytes(self.read_at(0, 13))
+        assert header[:3] == b"GIF" and header[3:6] in (b"89a", b"87a")
 
-        fp.seek(10, 0)
-        packed_filed = struct.unpack("B", fp.read(1))[0]
+        packed_filed = header[10]
+        if not packed_filed & 0x80:
+            return 6 + 7
         pixel = packed_filed & 7
         # index number of global color table
         size_indexOfGlobalColorTable = 2 ** (pixel + 1)
 
         return 6 + 7 + size_indexOfGlobalColorTable * 3
 
+    @timed()
+    def index(self):
+        """
+        Index every block of the data stream in one pass over an mmap.
+
+        Sub-block chains (image data, extension data) are skipped through
+        their length bytes only, no pixel is decoded. Each block is a dict
+        with its "type" ("comment", "application", "graphicControl",
+        "plainText", "extension" or "image"), "offset" of its first byte
+        and "end" one past its last byte. Images also carry their
+        geometry, local color table and the index of their graphic control
+        block; graphic control blocks their disposal, delay and
+        transparency.
+        """
+        if self.blocks is not None:
+            cache("LixxGIF.blocks", True)
+            return self.blocks
+        cache("LixxGIF.blocks", False)
+
+        view = self._view()
+        if view is not None:
+            self.blocks = _index(view, self._p_dataStream())
+            return self.blocks
+
+        fp = self.fp
+        fp.flush()
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            self.blocks = _index(buf, self._p_dataStream())
+        return self.blocks
+
+    def _blocks(self, typ):
+        return [block for block in self.index() if block["type"] == typ]
+
+    def frameCount(self):
+        """number of images, from the block index."""
+        return len(self._blocks("image"))
+
+    def comments(self):
+        """every comment of the file, wherever it is."""
+        return [DataSubBlock.decode(self._readBlock(block)[2:]).decode("utf-8") for block in self._blocks("comment")]
+
+    def _readBlock(self, block):
+        return self.read_at(block["offset"], block["end"] - block["offset"])
+
+    def _screen(self):
+        """logical screen width, height"""
+        return struct.unpack("<HH", self.read_at(6, 4))
+
+    def metadata(self):
+        """screen size, frame count, loop count, delays and comments, without decoding pixels."""
+        width, height = self._screen()
+
+        loop = None
+        for block in self._blocks("application"):
+            data = self._readBlock(block)
+            # NETSCAPE2.0 / ANIMEXTS1.0 looping sub-block: 3, 1, count
+            if data[3:14] in (b"NETSCAPE2.0", b"ANIMEXTS1.0") and data[14:16] == b"\x03\x01":
+                loop = struct.unpack("<H", data[16:18])[0]
+
+        blocks = self.index()
+        images = self._blocks("image")
+        return {
+            "width": width,
+            "height": height,
+            "frames": len(images),
+            "loop": loop,
+            "delays": [image["gce"] is not None and blocks[image["gce"]]["delay"] or 0 for image in images],
+            "comments": len(self._blocks("comment")),
+        }
+
+    def _palette(self, image):
+        """RGBA palette of an image, its local color table or the global one."""
+        if image["lct"] is not None:
+            offset, size = image["lct"]
+        else:
+            offset, size = 13, self._p_dataStream() - 13
+
+        rgb = np.frombuffer(self.read_at(offset, size), dtype=np.uint8).reshape(-1, 3)
+        palette = np.full((max(len(rgb), 1), 4), 255, dtype=np.uint8)
+        palette[:len(rgb), :3] = rgb
+        return palette
+
+    @timed()
+    def frameIndices(self, n):
+        """color indices of image `n` as a (height, width) uint8 array."""
+        image = self._blocks("image")[n]
+        data = self._readBlock(image)[image["data"] - image["offset"]:]
+        width, height = image["width"], image["height"]
+
+        pixels = _lzwDecode(DataSubBlock.decode(data[1:]), data[0], width * height)
+        # short data streams leave the rest of the frame at index 0
+        indices = np.zeros(width * height, dtype=np.uint8)
+        indices[:len(pixels)] = np.frombuffer(pixels, dtype=np.uint8)[:width * height]
+        indices = indices.reshape(height, width)
+
+        if image["interlace"]:
+            rows = np.concatenate([np.arange(start, height, step) for start, step in ((0, 8), (4, 8), (2, 4), (1, 2))])
+            res = np.empty_like(indices)
+            res[rows] = indices
+            indices = res
+        return indices
+
+    def _isKeyFrame(self, image, width, height):
+        """
+        an opaque image covering the whole screen hides every earlier frame,
+        unless it is disposed to previous (3): the next frame is drawn over the
+        screen as it was before it.
+        """
+        gce = image["gce"] is not None and self.index()[image["gce"]] or None
+        return (image["left"] == 0 and image["top"] == 0 and image["width"] >= width and image["height"] >= height
+                and (gce is None or gce["transparent"] is None and gce["disposal"] != 3))
+
+    def frames(self, start=None, stop=None, step=1, composite=True):
+        """
+        Lazily yield frames ``start:stop:step`` as RGBA uint8 arrays.
+
+        With `composite`, each frame is the (height, width, 4) screen after
+        drawing it over the earlier frames, honouring transparency and the
+        disposal methods. Frames between two wanted ones are only decoded
+        when no opaque full screen frame (per the block index) lets the
+        decoder jump ahead, a negative `step` redraws each frame from its
+        key frame. Without `composite`, each frame is just its own
+        image rectangle and nothing else is decoded.
+        """
+        blocks = self.index()
+        images = self._blocks("image")
+        targets = range(*slice(start, stop, step).indices(len(images)))
+
+        if not composite:
+            for n in targets:
+                yield self._palette(images[n]).take(self.frameIndices(n), axis=0, mode="clip")
+            return
+
+        width, height = self._screen()
+        keys = [n for n, image in enumerate(images) if self._isKeyFrame(image, width, height)]
+
+        canvas = None
+        pos = 0
+        dispose = None
+        for target in targets:
+            key = keys[bisect.bisect_right(keys, target) - 1] if keys and keys[0] <= target else 0
+            # a negative step goes back, start over from the key frame
+            if canvas is None or key > pos or target < pos:
+                canvas = np.zeros((height, width, 4), dtype=np.uint8)
+                pos, dispose = key, None
+
+            while pos <= target:
+                image = images[pos]
+                gce = image["gce"] is not None and blocks[image["gce"]] or None
+                top, left = image["top"], image["left"]
+                # rectangles past the screen edge draw nothing
+                bottom, right = max(min(top + image["height"], height), top), max(min(left + image["width"], width), left)
+
+                if dispose is not None:
+                    dispose()
+                    dispose = None
+
+                disposal = gce is not None and gce["disposal"] or 0
+                region = canvas[top:bottom, left:right]
+                if disposal == 2:
+                    def dispose(region=region):
+                        region[...] = 0
+                elif disposal == 3:
+                    def dispose(region=region, saved=region.copy()):
+                        region[...] = saved
+
+                indices = self.frameIndices(pos)[:bottom - top, :right - left]
+                rgba = self._palette(image).take(indices, axis=0, mode="clip")
+                if gce is not None and gce["transparent"] is not None:
+                    mask = indices != gce["transparent"]
+                    region[mask] = rgba[mask]
+                else:
+                    region[...] = rgba
+                pos += 1
+
+            yield canvas.copy()
+
+def _lzwDecode(data, minCodeSize, npixels):
+    """variable code size LZW, as GIF image data uses it."""
+    clear = 1 << minCodeSize
+    eoi = clear + 1
+
+    table = [bytes([i]) for i in range(clear)] + [b"", b""]
+    codeSize = minCodeSize + 1
+    codeMask = (1 << codeSize) - 1
+
+    res = bytearray()
+    prev = None
+    bitBuffer = bits = 0
+    for byte in data:
+        bitBuffer |= byte << bits
+        bits += 8
+        while bits >= codeSize:
+            code = bitBuffer & codeMask
+            bitBuffer >>= codeSize
+            bits -= codeSize
+
+            if code == clear:
+                del table[clear + 2:]
+                codeSize = minCodeSize + 1
+                codeMask = (1 << codeSize) - 1
+                prev = None
+                continue
+            if code == eoi:
+                return res
+
+            if prev is None:
+                entry = table[code] if code < len(table) else b"\x00"
+            else:
+                if code < len(table):
+                    entry = table[code]
+                else:
+                    entry = prev + prev[:1]
+                if len(table) < 4096:
+                    table.append(prev + entry[:1])
+                    if len(table) == codeMask + 1 and codeSize < 12:
+                        codeSize += 1
+                        codeMask = (1 << codeSize) - 1
+
+            res += entry
+            prev = entry
+            if len(res) >= npixels:
+                return res
+
+    return res
+
+def _skipSubBlocks(buf, pos):
+    """position just past the terminator of the sub-block chain at `pos`."""
+    size = buf[pos]
+    while size:
+        pos += size + 1
+        size = buf[pos]
+    return pos + 1
+
+def _index(buf, pos):
+    extensions = {0xfe: "comment", 0xff: "application", 0xf9: "graphicControl", 0x01: "plainText"}
+
+    blocks = []
+    gce = None
+    try:
+        while True:
+            introducer = buf[pos]
+            if introducer == 0x21:
+                label = buf[pos + 1]
+                block = {"type": extensions.get(label, "extension"), "offset": pos, "label": label}
+                if label == 0xf9:
+                    packed, delay, transparent = struct.unpack("<BHB", buf[pos + 3:pos + 7])
+                    block["disposal"] = (packed >> 2) & 7
+                    block["delay"] = delay
+                    block["transparent"] = transparent if packed & 1 else None
+                    gce = len(blocks)
+                elif label == 0x01:
+                    # plain text consumes the graphic control block too
+                    gce = None
+                block["end"] = _skipSubBlocks(buf, pos + 2)
+                if label == 0xfe:
+                    # older DataSubBlock padded comments with zero bytes
+                    while buf[block["end"]] == 0x00:
+                        block["end"] += 1
+            elif introducer == 0x2c:
+                left, top, width, height, packed = struct.unpack("<HHHHB", buf[pos + 1:pos + 10])
+                lct = packed & 0x80 and 3 * 2 ** ((packed & 7) + 1) or 0
+                block = {
+                    "type": "image",
+                    "offset": pos,
+                    "left": left,
+                    "top": top,
+                    "width": width,
+                    "height": height,
+                    "interlace": bool(packed & 0x40),
+                    "lct": lct and (pos + 10, lct) or None,
+                    "data": pos + 10 + lct,
+                    "gce": gce,
+                }
+                block["end"] = _skipSubBlocks(buf, pos + 10 + lct + 1)
+                gce = None
+            else:
+                # trailer, or garbage after the last block
+                break
+
+            blocks.append(block)
+            pos = block["end"]
+    except (IndexError, struct.error):
+        # truncated file, keep what was complete
+        pass
+
+    return blocks
+
 class DataSubBlock:
     """
          7 6 5 4 3 2 1 0        Field Name                    Type
@@ -110,6 +440,10 @@ class DataSubBlock:
             must be within 0 and 255 bytes, inclusive.
     Data Values - Any 8-bit value. There must be exactly as many
             Data Values as specified by the Block Size field.
+
+    Encoding writes full 255 byte blocks and one shorter last block,
+    without padding. Everything is built in a `bytearray` or streamed, so
+    the cost is linear in the payload size.
     """
 
     def __init__(self, content):
@@ -122,38 +456,63 @@ class DataSubBlock:
 
     def subBlock(self):
         """encode"""
-        content = self.content
-
-        blocks = len(content) // 255
-        partial = len(content) % 255
-
-        res = b""
-        for i in range(blocks):
-            tmp = struct.pack("B", 0xff)
-            tmp += content[i * 255 : i * 255 + 255]
-            res += tmp
-        
-        if partial:
-            tmp = struct.pack("B", partial)
-            tmp += content[blocks * 255:]
-            tmp += struct.pack("B", 0x00) * (256 - len(tmp))
-            res += tmp
-        
-        return res
-    
+        res = bytearray()
+        for block in self.iterEncode([self.content]):
+            res += block
+        return bytes(res)
+
     def __str__(self):
         """decode"""
-        content = self.content
-        assert len(content) % 256 == 0
-
-        blocks = math.ceil(len(content) / 256)
-        
-        res = b""
-        for i in range(blocks):
-            num = struct.unpack("B", content[i * 256: i * 256 + 1])[0]
-            res += content[i * 256 + 1 : i * 256 + 1 + num]
-        
-        return res.decode("utf-8")
+        return self.decode(self.content).decode("utf-8")
+
+    @staticmethod
+    def iterEncode(chunks):
+        """Yield the sub-blocks of a payload given as an iterable of bytes/str chunks."""
+        pending = bytearray()
+        for chunk in chunks:
+            if type(chunk) == str:
+                chunk = chunk.encode("utf-8")
+            view = memoryview(chunk).cast("B")
+
+            pos = 0
+            if pending:
+                pos = 255 - len(pending)
+                pending += view[:pos]
+                if len(pending) < 255:
+                    continue
+                yield b"\xff" + pending
+                pending = bytearray()
+
+            while len(view) - pos >= 255:
+                yield b"\xff" + view[pos:pos + 255]
+                pos += 255
+            pending += view[pos:]
+
+        if pending:
+            yield bytes([len(pending)]) + pending
+
+    @staticmethod
+    def decode(data):
+        """Payload of sub-blocks, up to the block terminator or the end of `data`."""
+        view = memoryview(data).cast("B")
+
+        res = bytearray()
+        pos = 0
+        while pos < len(view):
+            size = view[pos]
+            if not size:
+                break
+            res += view[pos + 1:pos + 1 + size]
+            pos += size + 1
+        return bytes(res)
+
+    @staticmethod
+    def iterDecode(fp):
+        """Yield the payload of the sub-blocks at the position of `fp`, one block at a time."""
+        size = fp.read(1)
+        while size and size != b"\x00":
+            yield fp.read(size[0])
+            size = fp.read(1)
 
 class GIFCommentExtension(LixxGIF):
     """
@@ -175,8 +534,8 @@ class GIFCommentExtension(LixxGIF):
         +---------------+ 
     """
 
-    def __init__(self, path):
-        super(GIFCommentExtension, self).__init__(path)
+    def __init__(self, path, mode="rb+", **options):
+        super(GIFCommentExtension, self).__init__(path, mode, **options)
         self.comment_offsets = None
         self.extensionIntroducer = struct.pack("B", 0x21)
         self.commentLabel = struct.pack("B", 0xfe)
@@ -187,79 +546,114 @@ class GIFCommentExtension(LixxGIF):
         commentLabel = self.commentLabel
         blockTerminator = self.blockTerminator
 
-        d_sb = DataSubBlock(comment)
-        comment = d_sb.subBlock()
-
-        return extensionIntroducer + commentLabel + comment + blockTerminator
+        res = bytearray(extensionIntroducer + commentLabel)
+        for block in DataSubBlock.iterEncode([comment]):
+            res += block
+        res += blockTerminator
+        return res
     
     def addComment(self, comment):
         """Add comment to the end of global color table."""
+        self.addComments([comment])
+
+    @timed()
+    def addComments(self, comments):
+        """Add comments to the end of global color table in a single pass."""
         fp = self.fp
         s_dataStream = self.s_dataStream
 
-        fp.seek(s_dataStream, 0)
-        rest = fp.read()
+        data = b"".join(self._commentExtension(comment) for comment in comments)
+        if not data:
+            return
 
+        # the backend view must not be exported while the file is written
+        self._invalidate()
+        _shift(fp, s_dataStream, len(data))
         fp.seek(s_dataStream, 0)
-        comment = self._commentExtension(comment)
-        fp.write(comment)
-        fp.write(rest)
+        fp.write(data)
+        fp.flush()
+
+        self.comment_offsets = None
+        self.blocks = None
 
+    @timed()
     def parseComments(self):
         """Return comments which next global color table."""
-        fp = self.fp
         s_dataStream = self.s_dataStream
-        extensionIntroducer = self.extensionIntroducer
-        commentLabel = self.commentLabel
-        blockTerminator = self.blockTerminator
 
-        fp.seek(s_dataStream, 0)
         res = []
-        while True:
-            if fp.read(1) != extensionIntroducer or fp.read(1) != commentLabel:
+        end = s_dataStream
+        for block in self.index():
+            if block["type"] != "comment" or block["offset"] != end:
                 break
-            subBlocks = b""
-            while fp.read(1) != blockTerminator:
-                fp.seek(-1, 1)
-                subBlocks += fp.read(256)
-            
-            res.append(subBlocks)
-        
+            res.append(DataSubBlock.decode(self._readBlock(block)[2:]))
+            end = block["end"]
+
         # update the num of bytes about comments for cleaning
-        offset = 0
-        for subBlocks in res:
-            offset += len(subBlocks)
-        self.comment_offsets = len(res) * 3 + offset
+        self.comment_offsets = end - s_dataStream
 
-        return [str(DataSubBlock(item)) for item in res]
+        return [item.decode("utf-8") for item in res]
 
+    @timed()
     def cleanComments(self):
         """Clean all comments which next global color table."""
         fp = self.fp
         s_dataStream = self.s_dataStream
         if self.comment_offsets is None:
-            self.parseComment()
+            self.parseComments()
         comment_offsets = self.comment_offsets
-        
-        fp.seek(s_dataStream, 0)
-        fp.seek(comment_offsets)
-        rest = fp.read()
 
-        fp.seek(s_dataStream, 0)
-        fp.write(rest)
-        fp.truncate()
+        self._invalidate()
+        _shift(fp, s_dataStream + comment_offsets, -comment_offsets)
+        fp.flush()
+
+        self.comment_offsets = None
+        self.blocks = None
+
+    @timed()
+    def stripComments(self):
+        """Remove every comment of the file, wherever it is, in one forward pass."""
+        fp = self.fp
+        gaps = [(block["offset"], block["end"]) for block in self._blocks("comment")]
+        if not gaps:
+            return
+
+        self._invalidate()
+        end = fp.seek(0, 2)
+        # the bytes between two comments move down over the removed ones
+        write = gaps[0][0]
+        for i, (start, stop) in enumerate(gaps):
+            pos, until = stop, i + 1 < len(gaps) and gaps[i + 1][0] or end
+            while pos < until:
+                n = min(CHUNK_SIZE, until - pos)
+                fp.seek(pos)
+                buf = fp.read(n)
+                fp.seek(write)
+                fp.write(buf)
+                write += n
+                pos += n
+        fp.truncate(write)
+        fp.flush()
 
         self.comment_offsets = None
+        self.blocks = None
 
 if __name__ == "__main__":
     """
         >>> gce = GIFCommentExtension(path)
         >>> # add comment
         >>> gce.addComment("I'm commtents.")
+        >>> gce.addComments(["first", "second"])
         >>> # get comments
         >>> comments = gce.parseComments()
         >>> # clean comments
         >>> gce.cleanComments()
+        >>> # or every comment, wherever it is
+        >>> gce.stripComments()
+        >>> # every 10th frame, composited
+        >>> for frame in gce.frames(step=10):
+        ...     frame.shape
+        (height, width, 4)
 
     """
     pass
\ No newline at end of file
@@ -18,9 +18,11 @@
 # @Email: Xixiang Zhu<hixxzhu@gmail.com>
 
 import struct
+import threading
+
 import numpy as np
 
-from Lixx_file import LixxFile
+from Lixx_file import LixxFile, CountingFile, cache, timed
 
 tags = {
     256: "ImageWidth",
@@ -59,10 +61,19 @@ types = {
 class LixxTIF(LixxFile):
     """TIFF Revision 6.0"""
 
-    def __init__(self, path, mode="rb+"):
-        super(LixxTIF, self).__init__(path, mode)
+    def __init__(self, path, mode="rb+", sampleFormat=2, **options):
+        """
+        @params: sampleFormat, assumed when the file has no SampleFormat tag: 2 signed like the int16 rasters
+                 LixxTIF always read, 1 unsigned as TIFF 6.0 defaults it (8 bit files saved by PIL, say)
+        @params: options, the LixxFile backend options
+        """
+        super(LixxTIF, self).__init__(path, mode, **options)
+        self.sampleFormat = sampleFormat
         self.byte_order, self.first_ifd = self._header()
-        self.ifds = self._ifds()
+        # one IFD per page, reduced-resolution overviews follow the full image
+        self.ifd_offsets = self._ifd_offsets()
+        self.level = 0
+        self.ifds = self._ifds(self.ifd_offsets[0])
 
         self.strips = []
         # image array
@@ -75,17 +86,12 @@ class LixxTIF(LixxFile):
 
     def __del__(self):
         self.close()
-    
-    def close(self):
-        self.fp.close()
 
     def _header(self):
-        fp = self.fp
-
-        fp.seek(0, 0)
-        byte_order = fp.read(2)
-        arbitary_number = fp.read(2)
-        first_ifd = fp.read(4)
+        header = bytes(self.read_at(0, 8))
+        byte_order = header[0:2]
+        arbitary_number = header[2:4]
+        first_ifd = header[4:8]
 
         if byte_order == b'\x49\x49':
             byte_order = "little"
@@ -103,26 +109,56 @@ class LixxTIF(LixxFile):
         byte_order = self.byte_order
         return int.from_bytes(b, byteorder=byte_order)
 
-    def _ifds(self):
-        fp = self.fp
-        byte_order = self.byte_order
-        first_ifd = self.first_ifd
+    def _ifd_offsets(self):
+        int_from_bytes = self.int_from_bytes
+
+        offsets = []
+        offset = int_from_bytes(self.first_ifd)
+        while offset and offset not in offsets:
+            offsets.append(offset)
+            ifd_num = int_from_bytes(self.read_at(offset, 2))
+            offset = int_from_bytes(self.read_at(offset + 2 + ifd_num * 12, 4))
+
+        return offsets
+
+    def _ifds(self, offset):
         int_from_bytes = self.int_from_bytes
 
         ifds = {}
-        ifd_num = int_from_bytes(fp.read(2))
+        ifd_num = int_from_bytes(self.read_at(offset, 2))
+        entries = self.read_at(offset + 2, ifd_num * 12)
         for i in range(ifd_num):
-            tag = fp.read(2)
+            entry = entries[i * 12:i * 12 + 12]
 
             tmp = {}
-            tmp["type"] = int_from_bytes(fp.read(2))
-            tmp["count"] = int_from_bytes(fp.read(4))
-            tmp["valueOrOffset"] = int_from_bytes(fp.read(4))
+            tmp["type"] = int_from_bytes(entry[2:4])
+            tmp["count"] = int_from_bytes(entry[4:8])
+            tmp["valueOrOffset"] = int_from_bytes(entry[8:12])
 
-            ifds[int_from_bytes(tag)] = tmp
+            ifds[int_from_bytes(entry[0:2])] = tmp
 
         return ifds
 
+    def levels(self):
+        """(width, height) of every page, full resolution first."""
+        res = []
+        for offset in self.ifd_offsets:
+            ifds = self._ifds(offset)
+            res.append((ifds[256]["valueOrOffset"], ifds[257]["valueOrOffset"]))
+
+        return res
+
+    def setLevel(self, level):
+        """switch to page `level`, the following reads use its IFD."""
+        with self.lock:
+            self.ifds = self._ifds(self.ifd_offsets[level])
+            self.level = level
+
+            self.strips = []
+            self.img = None
+            self.pointers = None
+            self.sign = False
+
     def __getitem__(self, key):
         ifds = self.ifds
 
@@ -155,13 +191,20 @@ class LixxTIF(LixxFile):
         width, height = self[256]["valueOrOffset"], self[257]["valueOrOffset"]
         return width, height
     
+    def dtype(self):
+        """numpy dtype of one sample, `sampleFormat` when the SampleFormat tag is missing."""
+        bits = self[258]["valueOrOffset"] if 258 in self.ifds else 16
+        sampleFormat = self[339]["valueOrOffset"] if 339 in self.ifds else self.sampleFormat
+
+        kind = {1: "u", 2: "i", 3: "f"}[sampleFormat]
+        order = self.byte_order == "little" and "<" or ">"
+        return np.dtype("%s%s%d" % (order, kind, bits // 8))
+
     def _strips(self):
         if self.strips:
+           cache("LixxTIF.strips", True)
            return self.strips
-
-        fp = self.fp
-        strips = self.strips
-        int_from_bytes = self.int_from_bytes
+        cache("LixxTIF.strips", False)
 
         StripOffsets = self[273]
         RowsPerStrip = self[278]
@@ -172,58 +215,46 @@ class LixxTIF(LixxFile):
 
         # value
         if StripByteCounts["count"] == 1 and StripOffsets["count"] == 1:
-            tmp = {}
-            tmp["byteCounts"] = StripByteCounts["valueOrOffset"]
-            tmp["offsets"] = StripOffsets["valueOrOffset"]
-            strips.append(tmp)
-            return strips
-
-        # offset
-        stripOffsets = []
-        fp.seek(StripOffsets["valueOrOffset"])
-        for i in range(StripOffsets["count"]):
-            offset = int_from_bytes(fp.read(4))
-            stripOffsets.append(offset)
-        
-        stripByteCounts = []
-        fp.seek(StripByteCounts["valueOrOffset"])
-        for i in range(StripByteCounts["count"]):
-            byteCount = int_from_bytes(fp.read(4))
-            stripByteCounts.append(byteCount)
+            stripOffsets = [StripOffsets["valueOrOffset"]]
+            stripByteCounts = [StripByteCounts["valueOrOffset"]]
 
-        
+        # offset, arrays of SHORT or LONG
+        else:
+            order = self.byte_order == "little" and "<" or ">"
+            fields = (StripOffsets, StripByteCounts)
+            dtypes = [np.dtype("%su%d" % (order, field["type"] == 3 and 2 or 4)) for field in fields]
+            ranges = [(field["valueOrOffset"], field["count"] * dtype.itemsize) for field, dtype in zip(fields, dtypes)]
+            stripOffsets, stripByteCounts = [np.frombuffer(buf, dtype=dtype).tolist() for buf, dtype in zip(self.read_many(ranges), dtypes)]
+
+        strips = []
         for i in range(len(stripOffsets)):
             tmp = {}
             tmp["byteCounts"] = stripByteCounts[i]
             tmp["offsets"] = stripOffsets[i]
             strips.append(tmp)
-        
+
+        # readRows may run on several threads, publish the list complete
+        self.strips = strips
         return strips
 
+    @timed()
     def _img(self):
         if self.img is not None and self.sign is False:
+            cache("LixxTIF.img", True)
             return self.img
+        cache("LixxTIF.img", False)
 
-        fp = self.fp
         strips = self._strips()
         width, height = self.scale()
-        int_from_bytes = self.int_from_bytes
+        itemsize = self.dtype().itemsize
+        rowsPerStrip = self[278]["valueOrOffset"]
 
-        cnt = -1
-        img = np.full((height, width), 0, dtype=np.int16)
-        pointers = np.full((height, width), 0, dtype=np.uint32)
-        for strip in strips:
-            offsets = strip["offsets"]
-            byteCounts = strip["byteCounts"]
-
-            fp.seek(offsets)
-            for i in range(byteCounts // 2):
-                cnt += 1
-                pixel = int_from_bytes(fp.read(2))
-                # print(cnt, cnt // width, cnt % width, pixel)
-                img[cnt // width][cnt % width] = pixel
-                pointer = offsets + i * 2
-                pointers[cnt // width][cnt % width] = pointer
+        img = self.readRows(0, height)
+
+        rows = np.arange(height)
+        rowOffsets = np.array([strip["offsets"] for strip in strips], dtype=np.uint32)[rows // rowsPerStrip]
+        rowOffsets += (rows % rowsPerStrip * width * itemsize).astype(np.uint32)
+        pointers = rowOffsets[:, np.newaxis] + (np.arange(width, dtype=np.uint32) * itemsize)
 
         self.img = img
         self.sign = False
@@ -231,39 +262,201 @@ class LixxTIF(LixxFile):
         return img
     
     def setPixel(self, h, w, val):
-        """val must be signed short(2 bytes)"""
+        """val must fit the sample type, see `dtype`"""
         if self.img is None:
             self._img()
 
         fp = self.fp
         pointers = self.pointers
-        byte_order = self.byte_order
 
-        pointer = pointers[h][w]
-        fp.seek(pointer)
-
-        fmt = byte_order == "little" and "<h" or ">h"
-        val = struct.pack(fmt, val)
-        fp.write(val)
+        # the backend view must not be exported while the file is written
+        self._invalidate()
+        fp.seek(int(pointers[h][w]))
+        fp.write(np.array(val, dtype=self.dtype()).tobytes())
+        fp.flush()
 
         self.sign = True
 
     def getPixel(self, h, w):
         """get pixel by file pointer withnot an array"""
 
-        fp = self.fp
         strips = self._strips()
         width, height = self.scale()
+        dtype = self.dtype()
         rowsPerStrip = self[278]["valueOrOffset"]
-        int_from_bytes = self.int_from_bytes
 
         assert w >=0 and w < width
         assert h >= 0 and h < height
 
         strip = strips[h // rowsPerStrip]
-        offset = strip["offsets"] + width * (h % rowsPerStrip) * 2 + w * 2
-        fp.seek(offset)
+        offset = strip["offsets"] + (width * (h % rowsPerStrip) + w) * dtype.itemsize
 
-        pixel = int_from_bytes(fp.read(2))
-        return np.int16(pixel)
-        
+        pixel = np.frombuffer(self.read_at(offset, dtype.itemsize), dtype=dtype)[0]
+        return pixel.astype(dtype.newbyteorder("="))
+
+    @timed()
+    def readRows(self, start, stop):
+        """read rows [start, stop) straight from the strips, without `_img`."""
+        width, height = self.scale()
+        dtype = self.dtype()
+        rowsPerStrip = self[278]["valueOrOffset"]
+        rowBytes = width * dtype.itemsize
+
+        start, stop = max(start, 0), min(stop, height)
+        rows = np.empty((max(stop - start, 0), width), dtype=dtype)
+
+        strips = self._strips()
+
+        # one range per strip, contiguous strips are read at once
+        ranges = []
+        h = start
+        while h < stop:
+            end = min(stop, (h // rowsPerStrip + 1) * rowsPerStrip)
+            ranges.append((strips[h // rowsPerStrip]["offsets"] + (h % rowsPerStrip) * rowBytes, (end - h) * rowBytes))
+            h = end
+
+        h = start
+        for buf in self.read_many(ranges):
+            n = len(buf) // rowBytes
+            rows[h - start:h - start + n] = np.frombuffer(buf, dtype=dtype).reshape(n, width)
+            h += n
+
+        return rows.astype(dtype.newbyteorder("="), copy=False)
+
+    @timed()
+    def takeRows(self, rows):
+        """read the rows of index array `rows`, in its order; adjacent rows are read at once."""
+        width, height = self.scale()
+        dtype = self.dtype()
+        rowsPerStrip = self[278]["valueOrOffset"]
+        rowBytes = width * dtype.itemsize
+
+        strips = self._strips()
+        ranges = [(strips[h // rowsPerStrip]["offsets"] + (h % rowsPerStrip) * rowBytes, rowBytes) for h in np.asarray(rows).tolist()]
+
+        res = np.empty((len(ranges), width), dtype=dtype)
+        for i, buf in enumerate(self.read_many(ranges)):
+            res[i] = np.frombuffer(buf, dtype=dtype)
+        return res.astype(dtype.newbyteorder("="), copy=False)
+
+class LixxTIFWriter:
+    """
+    Write an uncompressed, single band, striped TIFF row block by row block.
+
+    The header, IFDs and strip tables are written up front, so every row has
+    a fixed file offset and blocks may be written in any order. With
+    `overviews`, that many successive 2x reduced pages (NewSubfileType 1)
+    follow the full image, see `LixxTIF.setLevel`.
+    """
+
+    def __init__(self, path, width, height, dtype, rowsPerStrip=256, overviews=0):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.rowsPerStrip = rowsPerStrip
+
+        self.pages = [(width, height)]
+        for i in range(overviews):
+            w, h = self.pages[-1]
+            self.pages.append(((w + 1) // 2, (h + 1) // 2))
+
+        self.fp = CountingFile(open(path, "wb+"))
+        self.lock = threading.Lock()
+        self.data_offsets = self._header()
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if self.fp and not self.fp.closed:
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _page(self, s_ifd, level):
+        """IFD bytes of page `level` at `s_ifd`, its pixel data and next IFD offsets."""
+        width, height = self.pages[level]
+        itemsize = self.dtype.itemsize
+        rowsPerStrip = min(self.rowsPerStrip, height)
+        rowBytes = width * itemsize
+        sampleFormat = {"u": 1, "i": 2, "f": 3}[self.dtype.kind]
+
+        numStrips = -(-height // rowsPerStrip)
+        entries = 12
+        s_tables = s_ifd + 2 + entries * 12 + 4
+        s_data = s_tables + (numStrips > 1 and numStrips * 8 or 0)
+
+        stripOffsets = [s_data + i * rowsPerStrip * rowBytes for i in range(numStrips)]
+        stripByteCounts = [min(rowsPerStrip, height - i * rowsPerStrip) * rowBytes for i in range(numStrips)]
+        if numStrips > 1:
+            offsetsValue, countsValue = s_tables, s_tables + numStrips * 4
+        else:
+            offsetsValue, countsValue = stripOffsets[0], stripByteCounts[0]
+
+        ifd = [
+            (254, 4, 1, level > 0 and 1 or 0),
+            (256, 4, 1, width),
+            (257, 4, 1, height),
+            (258, 3, 1, itemsize * 8),
+            (259, 3, 1, 1),
+            (262, 3, 1, 1),
+            (273, 4, numStrips, offsetsValue),
+            (277, 3, 1, 1),
+            (278, 4, 1, rowsPerStrip),
+            (279, 4, numStrips, countsValue),
+            (284, 3, 1, 1),
+            (339, 3, 1, sampleFormat),
+        ]
+        assert len(ifd) == entries
+
+        res = struct.pack("<H", entries)
+        for tag, typ, count, value in ifd:
+            # SHORT values sit left-justified in the 4 byte field
+            fmt = typ == 3 and count == 1 and "<HHLHxx" or "<HHLL"
+            res += struct.pack(fmt, tag, typ, count, value)
+
+        # keep every IFD word aligned
+        s_next = s_data + height * rowBytes
+        s_next += s_next % 2
+        res += struct.pack("<L", level + 1 < len(self.pages) and s_next or 0)
+        if numStrips > 1:
+            res += struct.pack("<%dL" % numStrips, *stripOffsets)
+            res += struct.pack("<%dL" % numStrips, *stripByteCounts)
+
+        return res, s_data, s_next
+
+    def _header(self):
+        fp = self.fp
+        pages = self.pages
+
+        fp.seek(0, 0)
+        fp.write(b"II" + struct.pack("<HL", 42, 8))
+
+        data_offsets = []
+        s_ifd = 8
+        for level in range(len(pages)):
+            ifd, s_data, s_next = self._page(s_ifd, level)
+            fp.seek(s_ifd)
+            fp.write(ifd)
+            data_offsets.append(s_data)
+            s_ifd = s_next
+
+        # reserve the pixel data
+        fp.truncate(s_ifd)
+        return data_offsets
+
+    def writeRows(self, start, rows, level=0):
+        """write a (n, width) block of page `level` whose first row is `start`."""
+        width, height = self.pages[level]
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        assert rows.ndim == 2 and rows.shape[1] == width
+        assert 0 <= start and start + rows.shape[0] <= height
+
+        with self.lock:
+            self.fp.seek(self.data_offsets[level] + start * width * self.dtype.itemsize)
+            self.fp.write(rows.tobytes())
@@ -0,0 +1,232 @@
+# <Lixx_batch, a model for processing directories of dbf, tif and gif files.>
+# Copyright (C) <2018>  <Xiaowei Li, Xixiang Zhu>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# @Email: Xiaowei Li<lixiaowei7@live.cn>
+# @Email: Xixiang Zhu<hixxzhu@gmail.com>
+
+"""
+    $ python Lixx_batch.py stats data/ -r -j 8
+    $ python Lixx_batch.py comment-add gifs/ --comment "checked" -j 4
+    $ python Lixx_batch.py comment-strip gifs/
+    $ python Lixx_batch.py dbf2csv tables/ --out csv/ --json > report.jsonl
+"""
+
+import os
+import csv
+import sys
+import json
+import time
+import struct
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# dBASE / FoxPro version bytes
+DBF_VERSIONS = (0x02, 0x03, 0x04, 0x05, 0x30, 0x31, 0x32, 0x43, 0x63, 0x83, 0x8b, 0x8e, 0xcb, 0xf5, 0xfb)
+
+def detect(path):
+    """'gif', 'tif', 'dbf' from the magic bytes of `path`, None otherwise."""
+    with open(path, "rb") as f:
+        header = f.read(32)
+        size = f.seek(0, 2)
+
+    if header[:6] in (b"GIF89a", b"GIF87a"):
+        return "gif"
+    if header[:4] in (b"II*\x00", b"MM\x00*"):
+        return "tif"
+    if len(header) == 32 and header[0] in DBF_VERSIONS:
+        numrec, lenheader, lenrecord = struct.unpack("<LHH", header[4:12])
+        # LixxDBF recreates files it can not parse, be strict here
+        if 1 <= header[2] <= 12 and 1 <= header[3] <= 31 and lenheader >= 33 and lenheader + numrec * lenrecord <= size:
+            return "dbf"
+    return None
+
+def _stats(fmt, path, options):
+    if fmt == "dbf":
+        from Lixx_DBF import LixxDBF
+        with LixxDBF(path, mode="rb") as dbf:
+            return {"records": len(dbf.lixx_read()), "fieldnames": dbf.fieldnames, "fieldspecs": dbf.fieldspecs}
+
+    if fmt == "tif":
+        from Lixx_TIF import LixxTIF
+        with LixxTIF(path, "rb") as tif:
+            width, height = tif.scale()
+            total, low, high = 0.0, None, None
+            # row blocks keep memory flat on large rasters
+            for start in range(0, height, 256):
+                rows = tif.readRows(start, start + 256)
+                total += rows.sum(dtype="float64")
+                low = rows.min() if low is None else min(low, rows.min())
+                high = rows.max() if high is None else max(high, rows.max())
+            return {
+                "width": width,
+                "height": height,
+                "dtype": str(tif.dtype()),
+                "levels": len(tif.ifd_offsets),
+                "min": low.item() if low is not None else None,
+                "max": high.item() if high is not None else None,
+                "mean": total / (width * height) if width * height else None,
+            }
+
+    from Lixx_GIF import GIFCommentExtension
+    with GIFCommentExtension(path, "rb") as gif:
+        res = gif.metadata()
+        res["comments"] = gif.comments()
+        return res
+
+def _dbf2csv(path, options):
+    from Lixx_DBF import LixxDBF
+
+    out = options.get("out") or os.path.dirname(path)
+    target = os.path.join(out, os.path.splitext(os.path.basename(path))[0] + ".csv")
+    encoding = options.get("encoding") or "GBK"
+
+    with LixxDBF(path, mode="rb") as dbf:
+        records = dbf.lixx_read()
+        with open(target, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(dbf.fieldnames)
+            for record in records:
+                writer.writerow([item.decode(encoding, "replace").strip() for item in record])
+    return {"csv": target, "records": len(records)}
+
+def process(path, op, options):
+    """
+    Run operation `op` on one file, isolating any error in the result.
+
+    Every handle is closed before returning, whatever happens.
+    """
+    res = {"path": path, "op": op, "format": None, "ok": False}
+    start = time.perf_counter()
+    try:
+        fmt = res["format"] = detect(path)
+        if fmt is None:
+            res["skipped"] = "unknown format"
+        elif op == "stats":
+            res["result"] = _stats(fmt, path, options)
+        elif op in ("comment-add", "comment-strip"):
+            if fmt != "gif":
+                res["skipped"] = "not a gif"
+            else:
+                from Lixx_GIF import GIFCommentExtension
+                with GIFCommentExtension(path) as gif:
+                    if op == "comment-add":
+                        gif.addComments(options.get("comments") or [])
+                    else:
+                        gif.stripComments()
+                    # every comment left in the file, as stats lists them
+                    res["result"] = {"comments": gif.comments()}
+        elif op == "dbf2csv":
+            if fmt != "dbf":
+                res["skipped"] = "not a dbf"
+            else:
+                res["result"] = _dbf2csv(path, options)
+        else:
+            raise ValueError("Unknown operation %r." % op)
+        res["ok"] = "skipped" not in res
+    except Exception as e:
+        res["error"] = "%s: %s" % (type(e).__name__, e)
+    res["seconds"] = time.perf_counter() - start
+    return res
+
+def iter_paths(paths, recursive=False):
+    """files of `paths`, directories are listed (walked if `recursive`) in sorted order."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        if recursive:
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    yield os.path.join(root, name)
+        else:
+            for name in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, name)):
+                    yield os.path.join(path, name)
+
+def run(paths, op, workers=None, progress=None, **options):
+    """
+    Yield `process` results of every path, as they complete, from a process pool.
+
+    At most ``2 * workers`` files are submitted at a time, so a listing of
+    any length is never queued whole. `progress` is called with
+    (done, result) after each file.
+    """
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for done, path in enumerate(paths, 1):
+            res = process(path, op, options)
+            if progress:
+                progress(done, res)
+            yield res
+        return
+
+    done = 0
+    pending = set()
+    paths = iter(paths)
+    with ProcessPoolExecutor(workers) as pool:
+        while True:
+            for path in paths:
+                pending.add(pool.submit(process, path, op, options))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                res = future.result()
+                done += 1
+                if progress:
+                    progress(done, res)
+                yield res
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch process dbf, tif and gif files.")
+    parser.add_argument("op", choices=("stats", "comment-add", "comment-strip", "dbf2csv"))
+    parser.add_argument("paths", nargs="+", help="files or directories")
+    parser.add_argument("-r", "--recursive", action="store_true", help="walk directories")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="processes, default every core")
+    parser.add_argument("--comment", action="append", dest="comments", help="comment to add, repeatable")
+    parser.add_argument("--out", help="dbf2csv output directory, default next to the dbf")
+    parser.add_argument("--encoding", default="GBK", help="dbf2csv text encoding, default GBK")
+    parser.add_argument("--json", action="store_true", help="one json result per line on stdout")
+    parser.add_argument("-q", "--quiet", action="store_true", help="no progress on stderr")
+    args = parser.parse_args(argv)
+
+    if args.out:
+        os.makedirs(args.out, exist_ok=True)
+
+    def progress(done, res):
+        if args.quiet:
+            return
+        state = res["ok"] and "ok" or res.get("skipped") or "ERROR %s" % res.get("error")
+        sys.stderr.write("[%d] %s: %s\n" % (done, res["path"], state))
+
+    summary = collections.Counter()
+    results = run(iter_paths(args.paths, args.recursive), args.op, args.workers, progress,
+                  comments=args.comments, out=args.out, encoding=args.encoding)
+    for res in results:
+        summary[res["ok"] and "ok" or "skipped" in res and "skipped" or "failed"] += 1
+        if args.json:
+            sys.stdout.write(json.dumps(res, ensure_ascii=False, default=str) + "\n")
+
+    sys.stderr.write("ok: %d, skipped: %d, failed: %d\n" % (summary["ok"], summary["skipped"], summary["failed"]))
+    return summary["failed"] and 1 or 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,407 @@
+# <Lixx_bench, a model for benchmarking the Lixx readers and transformations.>
+# Copyright (C) <2018>  <Xiaowei Li, Xixiang Zhu>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+# @Email: Xiaowei Li<lixiaowei7@live.cn>
+# @Email: Xixiang Zhu<hixxzhu@gmail.com>
+
+"""
+    $ python Lixx_bench.py --sizes small,medium --out bench.json
+    $ python Lixx_bench.py --sizes small,medium --out new.json --compare bench.json
+
+Every input is generated from a fixed seed, so two runs on the same machine
+measure the same bytes. Each case keeps the best of `--repeat` runs and
+records its throughput and tracemalloc peak.
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import struct
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+# rows / fields / pixels / frames per size
+SIZES = {
+    "small": {"rows": 10000, "fields": 8, "pixels": 512, "frames": 4, "gif": 128},
+    "medium": {"rows": 100000, "fields": 16, "pixels": 2048, "frames": 8, "gif": 256},
+    "large": {"rows": 1000000, "fields": 16, "pixels": 8192, "frames": 16, "gif": 512},
+}
+
+# GBK text used for the character fields
+_WORDS = ["Lixx", "文件", "测试", "数据", "Archon", "Shuai", "北京", "上海", "地理", "遥感"]
+
+def make_dbf(path, rows, fields, seed=0):
+    """dBASE III file of `rows` records, half GBK character and half numeric fields."""
+    rng = np.random.default_rng(seed)
+    specs = [(i % 2 and "N" or "C", i % 2 and 10 or 20, 0) for i in range(fields)]
+    lenrecord = sum(spec[1] for spec in specs) + 1
+
+    with open(path, "wb") as f:
+        f.write(struct.pack("<BBBBLHH20x", 3, 118, 1, 1, rows, fields * 32 + 33, lenrecord))
+        for i, (typ, size, deci) in enumerate(specs):
+            f.write(struct.pack("<11sc4xBB14x", ("F%d" % i).encode("utf-8"), typ.encode("utf-8"), size, deci))
+        f.write(b"\r")
+
+        words = [word.encode("GBK") for word in _WORDS]
+        # records are written a block at a time
+        for start in range(0, rows, 10000):
+            n = min(10000, rows - start)
+            picks = rng.integers(0, len(words), (n, fields))
+            numbers = rng.integers(-10 ** 8, 10 ** 8, (n, fields))
+            block = bytearray()
+            for r in range(n):
+                block += b" "
+                for c, (typ, size, deci) in enumerate(specs):
+                    if typ == "N":
+                        block += str(numbers[r, c]).rjust(size).encode("utf-8")
+                    else:
+                        block += (words[picks[r, c]] * 4)[:size].ljust(size)
+            f.write(block)
+        f.write(b"\x1a")
+
+def _packbits(data):
+    """PackBits, literal runs only: valid and cheap, enough for the readers."""
+    res = bytearray()
+    for i in range(0, len(data), 128):
+        chunk = data[i:i + 128]
+        res.append(len(chunk) - 1)
+        res += chunk
+    return bytes(res)
+
+def make_tif(path, width, height, dtype=np.int16, compression=None, tile=None, rowsPerStrip=64, seed=0):
+    """
+    Single band TIFF of smooth noise, striped or tiled.
+
+    `compression` is None, "deflate" or "packbits", `tile` the (width,
+    height) of a tile for a tiled layout. The benchmark reads uncompressed
+    strips only, as LixxTIF does; the other layouts are for inputs made on
+    demand.
+    """
+    rng = np.random.default_rng(seed)
+    dtype = np.dtype(dtype).newbyteorder("<")
+    img = np.cumsum(rng.integers(-8, 9, (height, width)), axis=1).astype(dtype)
+
+    if tile:
+        tw, th = tile
+        chunks = []
+        for y in range(0, height, th):
+            for x in range(0, width, tw):
+                block = np.zeros((th, tw), dtype=dtype)
+                part = img[y:y + th, x:x + tw]
+                block[:part.shape[0], :part.shape[1]] = part
+                chunks.append(block.tobytes())
+    else:
+        chunks = [img[y:y + rowsPerStrip].tobytes() for y in range(0, height, rowsPerStrip)]
+
+    code = {None: 1, "deflate": 8, "packbits": 32773}[compression]
+    if compression == "deflate":
+        chunks = [zlib.compress(chunk, 6) for chunk in chunks]
+    elif compression == "packbits":
+        chunks = [_packbits(chunk) for chunk in chunks]
+
+    n = len(chunks)
+    entries = [
+        (256, 4, 1, width),
+        (257, 4, 1, height),
+        (258, 3, 1, dtype.itemsize * 8),
+        (259, 3, 1, code),
+        (262, 3, 1, 1),
+        (277, 3, 1, 1),
+        (284, 3, 1, 1),
+        (339, 3, 1, {"u": 1, "i": 2, "f": 3}[dtype.kind]),
+    ]
+    if tile:
+        entries += [(322, 4, 1, tile[0]), (323, 4, 1, tile[1]), (324, 4, n, None), (325, 4, n, None)]
+    else:
+        entries += [(273, 4, n, None), (278, 4, 1, rowsPerStrip), (279, 4, n, None)]
+    entries.sort()
+
+    s_tables = 8 + 2 + len(entries) * 12 + 4
+    s_data = s_tables + (n > 1 and n * 8 or 0)
+    offsets, pos = [], s_data
+    for chunk in chunks:
+        offsets.append(pos)
+        pos += len(chunk)
+    counts = [len(chunk) for chunk in chunks]
+
+    with open(path, "wb") as f:
+        f.write(b"II" + struct.pack("<HL", 42, 8))
+        f.write(struct.pack("<H", len(entries)))
+        for tag, typ, count, value in entries:
+            if value is None:
+                # offsets first, byte counts second
+                array = tag in (273, 324) and offsets or counts
+                value = n > 1 and s_tables + (tag in (279, 325) and n * 4 or 0) or array[0]
+            fmt = typ == 3 and count == 1 and "<HHLHxx" or "<HHLL"
+            f.write(struct.pack(fmt, tag, typ, count, value))
+        f.write(struct.pack("<L", 0))
+        if n > 1:
+            f.write(struct.pack("<%dL" % n, *offsets))
+            f.write(struct.pack("<%dL" % n, *counts))
+        for chunk in chunks:
+            f.write(chunk)
+
+    return img
+
+def _lzwEncode(indices, minCodeSize):
+    """GIF LZW, the encoder counterpart of Lixx_GIF._lzwDecode."""
+    clear = 1 << minCodeSize
+    eoi = clear + 1
+
+    res = bytearray()
+    bitBuffer = bits = 0
+
+    def emit(code, size):
+        nonlocal bitBuffer, bits
+        bitBuffer |= code << bits
+        bits += size
+        while bits >= 8:
+            res.append(bitBuffer & 0xff)
+            bitBuffer >>= 8
+            bits -= 8
+
+    table = {bytes([i]): i for i in range(clear)}
+    codeSize = minCodeSize + 1
+    emit(clear, codeSize)
+
+    prefix = b""
+    for byte in bytes(indices):
+        entry = prefix + bytes([byte])
+        if entry in table:
+            prefix = entry
+            continue
+
+        emit(table[prefix], codeSize)
+        if len(table) + 2 < 4096:
+            table[entry] = len(table) + 2
+            if len(table) + 2 > (1 << codeSize):
+                codeSize += 1
+        else:
+            emit(clear, codeSize)
+            table = {bytes([i]): i for i in range(clear)}
+            codeSize = minCodeSize + 1
+        prefix = bytes([byte])
+
+    if prefix:
+        emit(table[prefix], codeSize)
+    emit(eoi, codeSize)
+    if bits:
+        res.append(bitBuffer & 0xff)
+    return bytes(res)
+
+def make_gif(path, width, height, frames, seed=0):
+    """Looping GIF89a of `frames` full frames over a 256 color global table."""
+    from Lixx_GIF import DataSubBlock
+
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, (256, 3), dtype=np.uint8)
+
+    with open(path, "wb") as f:
+        f.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xf7, 0, 0))
+        f.write(palette.tobytes())
+        f.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")
+        for i in range(frames):
+            # smooth bands compress like real imagery, unlike white noise
+            y, x = np.mgrid[0:height, 0:width]
+            indices = ((x // 4 + y // 8 + i * 3 + rng.integers(0, 2, (height, width))) % 256).astype(np.uint8)
+
+            f.write(struct.pack("<BBBBHBB", 0x21, 0xf9, 4, 0x04, 10, 0, 0))
+            f.write(b"\x2c" + struct.pack("<HHHHB", 0, 0, width, height, 0))
+            f.write(b"\x08")
+            f.write(DataSubBlock(_lzwEncode(indices.tobytes(), 8)).subBlock())
+            f.write(b"\x00")
+        f.write(b"\x3b")
+
+def measure(func, repeat=3, setup=None):
+    """
+    best wall time of `repeat` runs, and the tracemalloc peak of one more.
+
+    tracemalloc slows every allocation down, so the timed runs go without it.
+    """
+    best = None
+    for i in range(repeat):
+        args = setup and (setup(),) or ()
+        start = time.perf_counter()
+        func(*args)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+
+    args = setup and (setup(),) or ()
+    tracemalloc.start()
+    try:
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+def _cases(size, spec, tmp, workers):
+    """(name, [(unit, amount), ...], func, setup) of every benchmark at one size."""
+    from Lixx_DBF import LixxDBF
+    from Lixx_TIF import LixxTIF
+    from Lixx_GIF import LixxGIF, GIFCommentExtension
+    import Lixx_trans
+
+    rows, fields, pixels, frames, gifSize = spec["rows"], spec["fields"], spec["pixels"], spec["frames"], spec["gif"]
+
+    dbf = os.path.join(tmp, "%s.dbf" % size)
+    make_dbf(dbf, rows, fields)
+    tif = os.path.join(tmp, "%s.tif" % size)
+    img = make_tif(tif, pixels, pixels)
+    gif = os.path.join(tmp, "%s.gif" % size)
+    make_gif(gif, gifSize, gifSize, frames)
+
+    dbfBytes = os.path.getsize(dbf)
+    tifBytes = img.nbytes
+    gifBytes = os.path.getsize(gif)
+
+    def read_records():
+        with LixxDBF(dbf, mode="rb") as f:
+            f.lixx_read()
+
+    def tif_img(backend):
+        def run():
+            with LixxTIF(tif, "rb", backend=backend) as f:
+                f._img()
+        return run
+
+    def copy_gif():
+        path = os.path.join(tmp, "%s-work.gif" % size)
+        shutil.copyfile(gif, path)
+        return path
+
+    def add_comment(path):
+        with GIFCommentExtension(path) as f:
+            f.addComment("Lixx " * 200)
+
+    def gif_index():
+        with LixxGIF(gif, "rb") as f:
+            f.index()
+
+    def gif_frames():
+        with LixxGIF(gif, "rb") as f:
+            for frame in f.frames():
+                pass
+
+    cases = [
+        ("dbf._read_records", [("rows", rows), ("MB", dbfBytes / 1e6)], read_records, None),
+        ("tif._img[buffered]", [("MB", tifBytes / 1e6)], tif_img("buffered"), None),
+        ("tif._img[mmap]", [("MB", tifBytes / 1e6)], tif_img("mmap"), None),
+    ]
+
+    for w in sorted({1, workers}):
+        cases += [
+            ("bilinear_interpolation x1.5 [%d]" % w, [("pixels", int(pixels * 1.5) ** 2)],
+             lambda w=w: Lixx_trans.bilinear_interpolation(img, 1.5, workers=w), None),
+            ("bytescale int16 [%d]" % w, [("pixels", img.size)], lambda w=w: Lixx_trans.bytescale(img, workers=w), None),
+            ("bytescale float32 [%d]" % w, [("pixels", img.size)],
+             lambda w=w, data=img.astype(np.float32): Lixx_trans.bytescale(data, workers=w), None),
+        ]
+
+    cases += [
+        ("gif.addComment", [("MB", gifBytes / 1e6)], add_comment, copy_gif),
+        ("gif.index", [("MB", gifBytes / 1e6)], gif_index, None),
+        ("gif.frames", [("pixels", gifSize * gifSize * frames)], gif_frames, None),
+    ]
+    return cases
+
+def run(sizes, repeat=3, workers=None, progress=None):
+    workers = workers or os.cpu_count() or 1
+    res = {
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "cpu_count": os.cpu_count(),
+        },
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeat": repeat,
+        "results": [],
+    }
+
+    tmp = tempfile.mkdtemp(prefix="lixx_bench_")
+    try:
+        for size in sizes:
+            for name, units, func, setup in _cases(size, SIZES[size], tmp, workers):
+                seconds, peak = measure(func, repeat, setup)
+                # one timing, reported in each unit of the case
+                for unit, amount in units:
+                    item = {
+                        "case": name,
+                        "size": size,
+                        "seconds": seconds,
+                        "throughput": amount / seconds,
+                        "unit": "%s/s" % unit,
+                        "peak_bytes": peak,
+                    }
+                    res["results"].append(item)
+                    if progress:
+                        progress(item)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return res
+
+def compare(new, old):
+    """new / old throughput of every case both runs share."""
+    baseline = {(item["case"], item["size"], item["unit"]): item for item in old["results"]}
+    res = []
+    for item in new["results"]:
+        key = (item["case"], item["size"], item["unit"])
+        if key in baseline:
+            res.append((key, item["throughput"] / baseline[key]["throughput"]))
+    return res
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the Lixx readers and transformations.")
+    parser.add_argument("--sizes", default="small", help="comma separated of %s" % ", ".join(SIZES))
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the best is kept")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="threads of the parallel cases")
+    parser.add_argument("--out", help="write the results as json")
+    parser.add_argument("--compare", help="json of an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes.split(",")
+    for size in sizes:
+        if size not in SIZES:
+            parser.error("unknown size %r" % size)
+
+    def progress(item):
+        print("{0:<36} {1:<7} {2:>14.1f} {3:<10} {4:>10.4f}s {5:>10.1f} MB peak".format(
+            item["case"], item["size"], item["throughput"], item["unit"], item["seconds"], item["peak_bytes"] / 1e6))
+
+    res = run(sizes, args.repeat, args.workers, progress)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(res, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print("\nthroughput vs %s" % args.compare)
+        for (case, size, unit), ratio in compare(res, old):
+            print("{0:<36} {1:<7} {2:<10} {3:>6.2f}x".format(case, size, unit, ratio))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,11 +17,186 @@
 # @Email: Xiaowei Li<lixiaowei7@live.cn>
 # @Email: Xixiang Zhu<hixxzhu@gmail.com>
 
+import io
+import os
+import time
+import mmap
+import threading
+import functools
+import contextlib
+import collections
+
+# LixxStats of the active `profile` blocks, innermost last
+_profilers = []
+
+class LixxStats:
+    """
+    Counters and timings collected while a `profile` block is active.
+
+    `counters` holds "reads", "writes", "seeks", "bytes_read",
+    "bytes_written", "cache_hits.<name>" and "cache_misses.<name>";
+    `times` the seconds spent per timed operation and `calls` how often it
+    ran. `hook`, when given, is called with (name, value) for every event.
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.counters = collections.Counter()
+        self.times = collections.Counter()
+        self.calls = collections.Counter()
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+        if self.hook:
+            self.hook(name, n)
+
+    def time(self, name, seconds):
+        self.times[name] += seconds
+        self.calls[name] += 1
+        if self.hook:
+            self.hook(name, seconds)
+
+    def as_dict(self):
+        return {"counters": dict(self.counters), "times": dict(self.times), "calls": dict(self.calls)}
+
+    def __str__(self):
+        res = ""
+        for name in sorted(self.counters):
+            res += "{0:<40} {1:>14}\n".format(name, self.counters[name])
+        for name in sorted(self.times):
+            res += "{0:<40} {1:>12.6f}s {2:>8} calls\n".format(name, self.times[name], self.calls[name])
+        return res
+
+@contextlib.contextmanager
+def profile(hook=None):
+    """
+    Collect I/O and hot path stats of every Lixx file and transform in the block.
+
+        >>> with profile() as stats:
+        ...     dbf.lixx_read()
+        >>> stats.counters["bytes_read"]
+
+    Outside a profile block the instrumentation costs one empty list check
+    per call.
+    """
+    stats = LixxStats(hook)
+    _profilers.append(stats)
+    try:
+        yield stats
+    finally:
+        _profilers.remove(stats)
+
+def profiling():
+    return bool(_profilers)
+
+def count(name, n=1):
+    for stats in _profilers:
+        stats.count(name, n)
+
+def cache(name, hit):
+    """count a cache lookup of `name`."""
+    if _profilers:
+        count((hit and "cache_hits." or "cache_misses.") + name)
+
+def timed(name=None):
+    """decorator, time every call of the function while profiling."""
+    def decorator(func):
+        key = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _profilers:
+                return func(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                seconds = time.perf_counter() - start
+                for stats in _profilers:
+                    stats.time(key, seconds)
+        return wrapper
+    return decorator
+
+class CountingFile:
+    """file object proxy counting reads, writes and seeks while profiling."""
+
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def read(self, n=-1):
+        data = self.raw.read(n)
+        if _profilers:
+            count("reads")
+            count("bytes_read", len(data))
+        return data
+
+    def write(self, data):
+        if _profilers:
+            count("writes")
+            count("bytes_written", len(data))
+        return self.raw.write(data)
+
+    def seek(self, offset, whence=0):
+        if _profilers:
+            count("seeks")
+        return self.raw.seek(offset, whence)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
 class LixxFile:
-    """a base class model for reading and writing uncommon files."""
+    """
+    a base class model for reading and writing uncommon files.
+
+    The file is read through one of three backends:
+
+    * "buffered" - a plain file object with `buffer_size` bytes of read-ahead.
+    * "mmap"     - the file is memory mapped, `read_at` slices are zero-copy.
+    * "memory"   - `path` is ``bytes`` / ``BytesIO`` (or a file loaded whole),
+                   `read_at` slices are zero-copy too. A file loaded whole is
+                   read only, its mode must be "rb": writes would only reach
+                   the private copy.
+
+    `read_at` and `read_many` are the positional reads every format should
+    use, `seek` / `_read` remain for sequential access.
+    """
+
+    backends = ("buffered", "mmap", "memory")
 
-    def __init__(self, path, mode="rb"):
-        self.fp = open(path, mode)
+    def __init__(self, path, mode="rb", backend="buffered", buffer_size=io.DEFAULT_BUFFER_SIZE):
+        # set before opening, `close` runs from __del__ even if opening fails
+        self.fp = None
+        # whole file view of the mmap / memory backends
+        self.view = None
+        self.mmap = None
+        # serializes seek + read of `read_at` on a shared file object
+        self.lock = threading.RLock()
+
+        if isinstance(path, (bytes, bytearray, memoryview, io.BytesIO)):
+            backend = "memory"
+        if backend not in self.backends:
+            raise ValueError("backend should be in %s, got %r." % (self.backends, backend))
+
+        self.mode = mode
+        self.backend = backend
+
+        if backend == "memory":
+            if isinstance(path, io.BytesIO):
+                self.fp = CountingFile(path)
+            else:
+                if not isinstance(path, (bytes, bytearray, memoryview)):
+                    if set(mode) & set("wax+"):
+                        raise ValueError("the memory backend loads %r read only, mode should be 'rb', got %r." % (path, mode))
+                    with open(path, "rb") as f:
+                        path = f.read()
+                self.fp = CountingFile(io.BytesIO(path))
+        elif backend == "mmap":
+            self.fp = CountingFile(open(path, mode))
+        else:
+            self.fp = CountingFile(open(path, mode, buffering=buffer_size))
 
     def __del__(self):
         pass
@@ -29,6 +204,21 @@ class LixxFile:
     def __str__(self):
         return self.lixx_info()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self._invalidate()
+        if self.fp is not None and not self.fp.closed:
+            try:
+                self.fp.close()
+            except BufferError:
+                # a BytesIO whose `read_at` slices are still alive
+                pass
+
     def lixx_read(self):
         pass
     
@@ -52,3 +242,92 @@ class LixxFile:
     def seek(self, offset, whence=0):
         """0-head, 1-now, 2-tail"""
         self.fp.seek(offset, whence)
+
+    def _view(self):
+        """memoryview of the whole file for the mmap / memory backends, else None."""
+        if self.view is not None or self.backend == "buffered":
+            return self.view
+
+        # several readRows threads may get here at once, map the file once
+        with self.lock:
+            if self.view is not None:
+                return self.view
+            fp = self.fp
+            if self.backend == "memory":
+                self.view = fp.getbuffer()
+            else:
+                fp.flush()
+                # fstat leaves the sequential position alone
+                if os.fstat(fp.fileno()).st_size == 0:
+                    # an empty file can not be mapped
+                    return None
+                self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.mmap)
+            return self.view
+
+    def _invalidate(self):
+        """drop the view, call it before the file is resized or written."""
+        view, self.view = self.view, None
+        try:
+            if view is not None:
+                view.release()
+            if self.mmap is not None:
+                self.mmap.close()
+        except BufferError:
+            # slices handed out by `read_at` are still alive, leave it to gc
+            pass
+        self.mmap = None
+
+    def read_at(self, offset, n):
+        """
+        `n` bytes from `offset`, without moving the sequential position.
+
+        The mmap and memory backends return a zero-copy memoryview, the
+        buffered one bytes.
+        """
+        view = self._view()
+        if view is not None:
+            if _profilers:
+                count("reads")
+                count("bytes_read", min(n, max(len(view) - offset, 0)))
+            return view[offset:offset + n]
+
+        with self.lock:
+            fp = self.fp
+            pos = fp.tell()
+            fp.seek(offset)
+            res = fp.read(n)
+            fp.seek(pos)
+        return res
+
+    def read_many(self, ranges, gap=0):
+        """
+        `read_at` for every (offset, n) of `ranges`, in their order.
+
+        Ranges which touch, overlap or are at most `gap` bytes apart are
+        fetched with one read and sliced.
+        """
+        order = sorted(range(len(ranges)), key=lambda i: ranges[i][0])
+
+        res = [None] * len(ranges)
+        group = []
+        start = end = None
+        for i in order + [None]:
+            if i is not None:
+                offset, n = ranges[i]
+                if group and offset <= end + gap:
+                    group.append(i)
+                    end = max(end, offset + n)
+                    continue
+
+            if group:
+                buf = memoryview(self.read_at(start, end - start))
+                for j in group:
+                    pos = ranges[j][0] - start
+                    res[j] = buf[pos:pos + ranges[j][1]]
+
+            if i is not None:
+                group = [i]
+                start, end = offset, offset + n
+
+        return res
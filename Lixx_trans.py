@@ -17,10 +17,119 @@
 # @Email: Xiaowei Li<lixiaowei7@live.cn>
 # @Email: Xixiang Zhu<hixxzhu@gmail.com>
 
+import os
 import math
+import functools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
-def bytescale(data, cmin=None, cmax=None, high=255, low=0):
+from Lixx_TIF import LixxTIFWriter
+from Lixx_file import cache, profiling, timed
+
+# elements per chunk of the float bytescale path
+_CHUNK = 1 << 18
+
+def run_row_chunks(func, height, workers=None, rows_per_chunk=None):
+    """
+    Call ``func(start, stop)`` over row chunks of ``range(height)``.
+
+    NumPy releases the GIL inside its loops, so chunks that write into
+    disjoint rows of one preallocated output run in parallel on a thread
+    pool of `workers` threads (default ``os.cpu_count()``). By default each
+    worker gets about four chunks to even out the load. Returns the results
+    in chunk order.
+    """
+    workers = workers or os.cpu_count() or 1
+    if rows_per_chunk is None:
+        rows_per_chunk = -(-height // (workers * 4)) if workers > 1 else height
+    rows_per_chunk = max(rows_per_chunk, 1)
+
+    chunks = [(start, min(start + rows_per_chunk, height)) for start in range(0, height, rows_per_chunk)]
+    if workers == 1 or len(chunks) <= 1:
+        return [func(start, stop) for start, stop in chunks]
+
+    with ThreadPoolExecutor(min(workers, len(chunks))) as pool:
+        return list(pool.map(lambda chunk: func(*chunk), chunks))
+
+# named percentile clips for `bytescale(stretch=...)`
+_STRETCH = {
+    "minmax": (0, 100),
+    "clip1": (1, 99),
+    "clip2": (2, 98),
+    "clip5": (5, 95),
+}
+
+def _percentiles(data, q_low, q_high):
+    """
+    "lower" percentiles (the sample at rank ``floor(q / 100 * (n - 1))``),
+    through a histogram for 8/16 bit integers.
+    """
+    if data.dtype.kind in "iu" and data.dtype.itemsize <= 2:
+        # the unsigned view orders signed values as [0, max] + [min, -1]
+        unsigned = data.dtype.newbyteorder("=").str.replace("i", "u")
+        values = np.arange(256 ** data.dtype.itemsize, dtype=unsigned).view(data.dtype)
+        hist = np.bincount(data.reshape(-1).view(unsigned), minlength=values.size)
+
+        order = np.argsort(values, kind="stable")
+        values, cum = values[order], np.cumsum(hist[order])
+        res = []
+        for q in (q_low, q_high):
+            rank = int(q / 100.0 * (cum[-1] - 1))
+            res.append(values[np.searchsorted(cum, rank, side="right")])
+        return res
+
+    return np.percentile(data, (q_low, q_high), method="lower")
+
+def _lookup(func, *args):
+    """call an lru_cache function, counting its hit or miss while profiling."""
+    if not profiling():
+        return func(*args)
+
+    misses = func.cache_info().misses
+    res = func(*args)
+    cache(func.__name__, func.cache_info().misses == misses)
+    return res
+
+@functools.lru_cache(maxsize=32)
+def _bytescale_lut(dtype, cmin, cmax, high, low):
+    """uint8 value of every 8/16 bit integer, indexed by its unsigned view."""
+    dtype = np.dtype(dtype)
+    unsigned = dtype.str.replace("i", "u")
+    values = np.arange(256 ** dtype.itemsize, dtype=unsigned).view(dtype)
+
+    scale = float(high - low) / (cmax - cmin or 1)
+    lut = (values.astype(np.float64) - cmin) * scale + low
+    lut = (lut.clip(low, high) + 0.5).astype(np.uint8)
+
+    lut.flags.writeable = False
+    return lut
+
+def _bytescale_into(data, out, cmin, cmax, high, low):
+    if data.dtype.kind in "iu" and data.dtype.itemsize <= 2:
+        dtype = data.dtype.newbyteorder("=")
+        lut = _lookup(_bytescale_lut, dtype.str, cmin, cmax, high, low)
+        index = data.astype(dtype, copy=False).view(dtype.str.replace("i", "u"))
+        return np.take(lut, index, out=out)
+
+    scale = float(high - low) / (cmax - cmin or 1)
+    flat = data.reshape(-1)
+    flat_out = out.reshape(-1)
+    buf = np.empty(min(flat.size, _CHUNK), dtype=np.float64)
+    for start in range(0, flat.size, _CHUNK):
+        chunk = flat[start:start + _CHUNK]
+        tmp = buf[:chunk.size]
+        np.subtract(chunk, cmin, out=tmp)
+        tmp *= scale
+        tmp += low
+        np.clip(tmp, low, high, out=tmp)
+        tmp += 0.5
+        np.copyto(flat_out[start:start + _CHUNK], tmp, casting="unsafe")
+    return out
+
+@timed()
+def bytescale(data, cmin=None, cmax=None, high=255, low=0, stretch=None, out=None, workers=1):
     """
     Byte scales an array (image).
 
@@ -28,6 +137,12 @@ def bytescale(data, cmin=None, cmax=None, high=255, low=0):
     the range to ``(low, high)`` (default 0-255).
     If the input image already has dtype uint8, no scaling is done.
 
+    8 and 16 bit integer inputs, such as LixxTIF rasters, are mapped through
+    a lookup table of every possible value with a single ``np.take``; the
+    table is cached per (dtype, cmin, cmax, low, high). Other inputs are
+    scaled in place chunk by chunk, so only one chunk sized temporary is
+    allocated.
+
     Parameters
     ----------
     data : ndarray
@@ -40,6 +155,16 @@ def bytescale(data, cmin=None, cmax=None, high=255, low=0):
         Scale max value to `high`.  Default is 255.
     low : scalar, optional
         Scale min value to `low`.  Default is 0.
+    stretch : str or (scalar, scalar), optional
+        Percentile clip used for a missing `cmin` / `cmax`, either one of
+        "minmax", "clip1", "clip2", "clip5" or ``(q_low, q_high)`` in
+        percent, taken as "lower" percentiles (no interpolation) for every
+        dtype. Default is "minmax".
+    out : uint8 ndarray, optional
+        C-contiguous array of ``data.shape`` to write the result into.
+    workers : int, optional
+        Threads to split the rows over, see `run_row_chunks`. ``None`` uses
+        every core. Default is 1.
 
     Returns
     -------
@@ -64,10 +189,21 @@ def bytescale(data, cmin=None, cmax=None, high=255, low=0):
     array([[91,  3, 84],
            [74, 81,  5],
            [52, 34, 28]], dtype=uint8)
+    >>> bytescale(img, stretch="clip5")
+    array([[255,   0, 255],
+           [222, 244,   5],
+           [152,  98,  76]], dtype=uint8)
 
     """
+    if out is not None:
+        if out.dtype != np.uint8 or out.shape != data.shape or not out.flags.c_contiguous:
+            raise ValueError("`out` should be a C-contiguous uint8 array of the data's shape.")
+
     if data.dtype == np.uint8:
-        return data
+        if out is None:
+            return data
+        out[...] = data
+        return out
 
     if high > 255:
         raise ValueError("`high` should be less than or equal to 255.")
@@ -76,51 +212,353 @@ def bytescale(data, cmin=None, cmax=None, high=255, low=0):
     if high < low:
         raise ValueError("`high` should be greater than or equal to `low`.")
 
-    if cmin is None:
-        cmin = data.min()
-    if cmax is None:
-        cmax = data.max()
+    if cmin is None or cmax is None:
+        q_low, q_high = _STRETCH[stretch or "minmax"] if isinstance(stretch, str) or stretch is None else stretch
+        if (q_low, q_high) == (0, 100):
+            res = run_row_chunks(lambda start, stop: (data[start:stop].min(), data[start:stop].max()),
+                                 len(data), workers)
+            p_low, p_high = min(item[0] for item in res), max(item[1] for item in res)
+        else:
+            p_low, p_high = _percentiles(data, q_low, q_high)
+        cmin = p_low if cmin is None else cmin
+        cmax = p_high if cmax is None else cmax
 
-    cscale = cmax - cmin
-    if cscale < 0:
+    cmin, cmax = float(cmin), float(cmax)
+    if cmax - cmin < 0:
         raise ValueError("`cmax` should be larger than `cmin`.")
-    elif cscale == 0:
-        cscale = 1
-
-    scale = float(high - low) / cscale
-    bytedata = (data - cmin) * scale + low
-    return (bytedata.clip(low, high) + 0.5).astype(np.uint8)
-
-def _bilinear(p_00, p_01, p_10, p_11, frac_w, frac_h):
-    return (1 - frac_w) * (1 - frac_h) * p_00 + (1 - frac_w) * frac_h * p_01 + frac_w * (1 - frac_h) * p_10 + frac_w * frac_h * p_11
-
-def bilinear_interpolation(img, multiple=1):
-    """resize the img with multiple"""
-
-    if img.dtype != np.uint8:
-        raise ValueError("The array's dtype must be uint8.")
-
-    srcHeight, srcWidth = img.shape
-    dstWidth = math.floor(srcWidth * multiple)
-    dstHeight = math.floor(srcHeight * multiple)
-
-    dst_img = np.zeros((dstHeight, dstWidth), dtype=np.uint8)
-
-    for dst_h in range(len(dst_img)):
-        for dst_w in range(len(dst_img[dst_h])):
-            src_h = dst_h * srcHeight / dstHeight
-            src_w = dst_w * srcWidth / dstWidth
-            
-            inte_h = math.floor(src_h)
-            inte_w = math.floor(src_w)
-            frac_h = src_h - inte_h
-            frac_w = src_w - inte_w
-
-            p_00 = img[inte_h][inte_w]
-            p_01 = img[inte_h][inte_w + 1 < srcWidth and inte_w + 1 or inte_w]
-            p_10 = img[inte_h + 1 < srcHeight and inte_h + 1 or inte_h][inte_w]
-            p_11 = img[inte_h + 1 < srcHeight and inte_h + 1 or inte_h][inte_w + 1 < srcWidth and inte_w + 1 or inte_w]
-
-            dst_img[dst_h][dst_w] = _bilinear(p_00, p_01, p_10, p_11, frac_w, frac_h)
-    
-    return dst_img
\ No newline at end of file
+
+    if out is None:
+        out = np.empty(data.shape, dtype=np.uint8)
+    if data.ndim == 0:
+        return _bytescale_into(data, out, cmin, cmax, high, low)
+
+    run_row_chunks(lambda start, stop: _bytescale_into(data[start:stop], out[start:stop], cmin, cmax, high, low),
+                   len(data), workers)
+    return out
+
+@functools.lru_cache(maxsize=64)
+def _bilinear_weights(srcLength, dstLength):
+    """source indices and weights along one axis, cached per (src, dst) length."""
+    src = np.arange(dstLength, dtype=np.float64) * srcLength / dstLength
+    inte = np.floor(src).astype(np.intp)
+    frac = src - inte
+    inte_next = np.minimum(inte + 1, srcLength - 1)
+
+    for arr in (inte, inte_next, frac):
+        arr.flags.writeable = False
+    return inte, inte_next, frac
+
+def _dst_shape(srcHeight, srcWidth, multiple, shape):
+    if shape is not None:
+        dstHeight, dstWidth = shape
+    else:
+        if np.ndim(multiple) == 0:
+            multiple_h = multiple_w = multiple
+        else:
+            multiple_h, multiple_w = multiple
+        dstHeight = math.floor(srcHeight * multiple_h)
+        dstWidth = math.floor(srcWidth * multiple_w)
+
+    if dstHeight <= 0 or dstWidth <= 0:
+        raise ValueError("The output shape must be positive, got (%d, %d)." % (dstHeight, dstWidth))
+    return int(dstHeight), int(dstWidth)
+
+def _bilinear_block(img, h0, h1, frac_h, w0, w1, frac_w):
+    """gather and blend rows, then columns. Returns float64."""
+    # broadcast the weights over the trailing (width[, channels]) axes
+    frac_h = frac_h.reshape((-1,) + (1,) * (img.ndim - 1))
+    frac_w = frac_w.reshape((-1,) + (1,) * (img.ndim - 2))
+
+    rows = img[h0] * (1 - frac_h)
+    rows += img[h1] * frac_h
+
+    dst_img = rows[:, w0] * (1 - frac_w)
+    dst_img += rows[:, w1] * frac_w
+    return dst_img
+
+def _cast(data, dtype):
+    """cast float64 results back to `dtype`, saturating integers."""
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        np.clip(data, info.min, info.max, out=data)
+    return data.astype(dtype, copy=False)
+
+@timed()
+def bilinear_interpolation(img, multiple=1, shape=None, workers=1):
+    """
+    Resize the img with bilinear interpolation.
+
+    The resampling is separable: rows are interpolated first, then columns,
+    each with one vectorized gather. Source indices and weights are cached
+    per (source, destination) length, so resizing many tiles of the same
+    size only builds them once.
+
+    Parameters
+    ----------
+    img : ndarray
+        2-D ``(height, width)`` or 3-D ``(height, width, channels)`` array
+        of any numeric dtype.
+    multiple : scalar or (scalar, scalar), optional
+        Scale factor, or ``(multiple_h, multiple_w)`` for separate y/x
+        scales. Ignored when `shape` is given. Default is 1.
+    shape : (int, int), optional
+        Explicit output ``(height, width)``.
+    workers : int, optional
+        Threads to split the output rows over, see `run_row_chunks`.
+        ``None`` uses every core. Default is 1.
+
+    Returns
+    -------
+    dst_img : ndarray
+        The resized array, same dtype as `img`. Integer results are
+        truncated, as in the pixel loop this replaces.
+    """
+    img = np.asarray(img)
+    if img.ndim not in (2, 3):
+        raise ValueError("The array must be 2-D or 3-D, got %d-D." % img.ndim)
+
+    srcHeight, srcWidth = img.shape[:2]
+    dstHeight, dstWidth = _dst_shape(srcHeight, srcWidth, multiple, shape)
+
+    h0, h1, frac_h = _lookup(_bilinear_weights, srcHeight, dstHeight)
+    w0, w1, frac_w = _lookup(_bilinear_weights, srcWidth, dstWidth)
+
+    dst_img = np.empty((dstHeight, dstWidth) + img.shape[2:], dtype=img.dtype)
+
+    def work(start, stop):
+        # only the source rows of this chunk, the halo row below included
+        s_start, s_stop = h0[start], h1[stop - 1] + 1
+        block = _bilinear_block(img[s_start:s_stop], h0[start:stop] - s_start, h1[start:stop] - s_start,
+                                frac_h[start:stop], w0, w1, frac_w)
+        dst_img[start:stop] = _cast(block, img.dtype)
+
+    run_row_chunks(work, dstHeight, workers)
+    return dst_img
+
+def _bounded_map(pool, fn, items, window):
+    """like pool.map, but keeps at most `window` items in flight."""
+    pending = collections.deque()
+    try:
+        for item in items:
+            if len(pending) >= window:
+                yield pending.popleft().result()
+            pending.append(pool.submit(fn, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # on an error, the items not started yet are dropped
+        for future in pending:
+            future.cancel()
+
+def _tif_minmax(tif, pool, rows_per_block, window):
+    width, height = tif.scale()
+
+    def minmax(start):
+        rows = tif.readRows(start, start + rows_per_block)
+        return rows.min(), rows.max()
+
+    res = list(_bounded_map(pool, minmax, range(0, height, rows_per_block), window))
+    return min(item[0] for item in res), max(item[1] for item in res)
+
+@timed()
+def resample_tif(tif, path, multiple=1, shape=None, scale=True, cmin=None, cmax=None,
+                 high=255, low=0, rows_per_block=256, workers=None):
+    """
+    Bilinear resample (and byte scale) a LixxTIF into a new TIF, block by block.
+
+    Output row blocks are produced on a thread pool. Each block reads only
+    the source rows it samples, halo rows included, and is written straight to
+    `path`, so peak memory stays around ``2 * workers`` blocks whatever the
+    raster size.
+
+    Parameters
+    ----------
+    tif : LixxTIF
+        The source image.
+    path : str
+        Output path, an uncompressed striped TIF with `rows_per_block`
+        rows per strip.
+    multiple, shape :
+        As for `bilinear_interpolation`.
+    scale : bool, optional
+        Byte scale each block to uint8, as `bytescale` does. Default is True.
+    cmin, cmax, high, low : optional
+        As for `bytescale`. A missing `cmin` / `cmax` costs one extra
+        streaming pass over the source to find its min / max.
+    rows_per_block : int, optional
+        Output rows per block. Default is 256.
+    workers : int, optional
+        Thread pool size. Default is ``os.cpu_count()``.
+
+    Returns
+    -------
+    (height, width) of the output.
+    """
+    srcWidth, srcHeight = tif.scale()
+    dstHeight, dstWidth = _dst_shape(srcHeight, srcWidth, multiple, shape)
+    srcDtype = tif.dtype().newbyteorder("=")
+    scale = scale and srcDtype != np.uint8
+
+    h0, h1, frac_h = _lookup(_bilinear_weights, srcHeight, dstHeight)
+    w0, w1, frac_w = _lookup(_bilinear_weights, srcWidth, dstWidth)
+
+    workers = workers or os.cpu_count() or 1
+    window = 2 * workers
+
+    dtype = scale and np.uint8 or srcDtype
+    writer = LixxTIFWriter(path, dstWidth, dstHeight, dtype, rows_per_block)
+    try:
+        # the pool exits first, so running blocks finish before the writer closes
+        with writer, ThreadPoolExecutor(workers) as pool:
+            if scale and (cmin is None or cmax is None):
+                srcMin, srcMax = _tif_minmax(tif, pool, rows_per_block, window)
+                cmin = srcMin if cmin is None else cmin
+                cmax = srcMax if cmax is None else cmax
+
+            def work(start):
+                stop = min(start + rows_per_block, dstHeight)
+                # only the source rows this block samples, however far apart
+                # a large shrink puts them, the halo row below included
+                rows = np.unique(np.r_[h0[start:stop], h1[start:stop]])
+
+                src = tif.takeRows(rows)
+                block = _bilinear_block(src, np.searchsorted(rows, h0[start:stop]), np.searchsorted(rows, h1[start:stop]),
+                                        frac_h[start:stop], w0, w1, frac_w)
+                if scale:
+                    block = bytescale(block, cmin, cmax, high, low)
+                else:
+                    block = _cast(block, dtype)
+                writer.writeRows(start, block)
+
+            for _ in _bounded_map(pool, work, range(0, dstHeight, rows_per_block), window):
+                pass
+    except BaseException:
+        # no half written output is left behind
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    return dstHeight, dstWidth
+
+def _downsample2(rows, method):
+    """2x reduce a (h, w) block, odd edges replicate their last row / column."""
+    if method == "nearest":
+        return rows[::2, ::2]
+
+    height, width = rows.shape
+    if height % 2 or width % 2:
+        rows = np.pad(rows, ((0, height % 2), (0, width % 2)), mode="edge")
+
+    work = rows.astype(np.float64)
+    res = work[0::2, 0::2] + work[1::2, 0::2]
+    res += work[0::2, 1::2]
+    res += work[1::2, 1::2]
+    res *= 0.25
+    if np.issubdtype(rows.dtype, np.integer):
+        np.rint(res, out=res)
+    return _cast(res, rows.dtype)
+
+@timed()
+def build_pyramid(tif, path, levels=None, method="average", min_size=256, rows_per_block=256):
+    """
+    Build successive 2x overviews of a LixxTIF in one streaming pass.
+
+    `path` receives the full image followed by one reduced-resolution IFD
+    per level; open it with LixxTIF and pick a level with `setLevel`. Each
+    level is reduced from the rows of the previous one as they stream by,
+    so only a block and one carried odd row per level are held in memory.
+
+    Parameters
+    ----------
+    tif : LixxTIF
+        The source image.
+    path : str
+        Output path.
+    levels : int, optional
+        Number of overviews. Default halves until the smaller side is at
+        most `min_size`.
+    method : {"average", "nearest"}, optional
+        "average" is a 2x2 area mean, "nearest" keeps every other pixel and
+        suits categorical data. Default is "average".
+    min_size : int, optional
+        See `levels`. Default is 256.
+    rows_per_block : int, optional
+        Source rows read per step, also the strip height. Default is 256.
+
+    Returns
+    -------
+    [(width, height), ...] of every page written, full resolution first.
+    """
+    if method not in ("average", "nearest"):
+        raise ValueError("`method` should be 'average' or 'nearest'.")
+
+    width, height = tif.scale()
+    if levels is None:
+        levels, size = 0, min(width, height)
+        while size > min_size:
+            levels, size = levels + 1, (size + 1) // 2
+
+    # rows already written, and the odd row waiting for its pair, per page
+    written = [0] * (levels + 1)
+    pending = [None] * (levels + 1)
+
+    with LixxTIFWriter(path, width, height, tif.dtype().newbyteorder("="), rows_per_block, levels) as writer:
+
+        def feed(level, rows, final):
+            writer.writeRows(written[level], rows, level)
+            written[level] += rows.shape[0]
+            if level == levels:
+                return
+
+            if pending[level] is not None:
+                rows = np.concatenate((pending[level], rows))
+                pending[level] = None
+            if not final and rows.shape[0] % 2:
+                pending[level] = rows[-1:]
+                rows = rows[:-1]
+            if rows.shape[0] or final:
+                feed(level + 1, _downsample2(rows, method), final)
+
+        for start in range(0, height, rows_per_block):
+            feed(0, tif.readRows(start, start + rows_per_block), start + rows_per_block >= height)
+
+        return writer.pages
+
+if __name__ == "__main__":
+    """
+    Thread scaling of the chunked transforms:
+
+        $ python Lixx_trans.py [size] [max_workers]
+
+    defaults to a 16384 x 16384 array and up to 8 workers.
+    """
+    import sys
+    import time
+
+    size = len(sys.argv) > 1 and int(sys.argv[1]) or 16384
+    max_workers = len(sys.argv) > 2 and int(sys.argv[2]) or 8
+
+    rng = np.random.default_rng(0)
+    img16 = rng.integers(-2000, 2000, (size, size), dtype=np.int16)
+    img32 = img16.astype(np.float32)
+    out = np.empty((size, size), dtype=np.uint8)
+
+    cases = [
+        ("bytescale int16", lambda workers: bytescale(img16, -2000, 2000, out=out, workers=workers)),
+        ("bytescale float32", lambda workers: bytescale(img32, -2000, 2000, out=out, workers=workers)),
+        ("bilinear x0.75 int16", lambda workers: bilinear_interpolation(img16, 0.75, workers=workers)),
+    ]
+
+    print("%d x %d, %d cores" % (size, size, os.cpu_count()))
+    for name, case in cases:
+        # warm up the LUT / weight caches
+        case(1)
+        base = None
+        workers = 1
+        while workers <= max_workers:
+            t = time.perf_counter()
+            case(workers)
+            t = time.perf_counter() - t
+            base = base or t
+            print("{0:<22} workers={1:<3} {2:8.3f}s  speedup {3:5.2f}".format(name, workers, t, base / t))
+            workers *= 2